@@ -1,21 +1,26 @@
 from ssi.iot_api_client import IotApiClient
 from ssi.api_client import ApiException
-import pandas as pd
 import datetime
 import os
-from tabulate import tabulate
+import sys
+import mmap
 from pprint import pprint
-from io import StringIO
+from io import StringIO, BytesIO
 
-# Some nice helper functions
+# Some nice helper functions. The heavier imports in this example are done
+# where they are first needed so that early exits (no token, no device) stay
+# fast
 def pretty_dict(d):
-    print(tabulate(d.items()))
+    from tabulate import tabulate
+    print(tabulate(d.items(), disable_numparse=True, tablefmt='plain'))
 
 def pretty_list(d):
     if len(d) == 0 or not isinstance(d[0], dict):
         pprint(d)
     else:
-        print(tabulate(d, headers='keys'))
+        from tabulate import tabulate
+        print(tabulate(d, headers='keys', disable_numparse=True,
+                       tablefmt='plain'))
 # This token must be generated from the web interface.
 # You can set it in your environemnt like this example or you can put it in
 # your code. Be careful not to distribute code with secrets
@@ -27,14 +32,11 @@ client = IotApiClient(token = token)
 print("Connected, getting  devices")
 # Grab a list of all the devices we can admin
 devices = client.get_my_devices()
-device = None
-for d in devices:
-    if d.hostname == "hanover-rev-g-greenhouse-system":
-        device = d
-        break
-if not device:
+target_hostname = "hanover-rev-g-greenhouse-system"
+device = next((d for d in devices if d.hostname == target_hostname), None)
+if device is None:
     print("Could not find device")
-    exit(1)
+    sys.exit(1)
 
 
 # Read the ert status of the system
@@ -56,7 +58,33 @@ sequence = device.get_file_data(f'config/sequences/user/{sequence_file_name}')
 # We can read the sequence file as a pandas dataframe because it's just a tab
 # separated values file
 print(f"Contents of sequence file {sequence_file_name}")
-df = pd.read_csv(StringIO(sequence), sep='\t')
+# The columns are known ahead of time, so give pandas the types instead of
+# making it infer them. get_file_data may hand back bytes depending on the
+# content type reported by the server, in which case we skip the decode
+sequence_dtypes = {col: 'int32' for col in
+                   ('Awell', 'Aelec', 'Bwell', 'Belec',
+                    'Mwell', 'Melec', 'Nwell', 'Nelec')}
+import pandas as pd
+# Polars is optional, it is only used to speed up parsing if it is installed.
+# Converting its result to pandas needs pyarrow, so both must be present
+try:
+    import polars as pl
+    import pyarrow
+except ImportError:
+    pl = None
+if pl is not None:
+    # Polars has a faster multithreaded CSV reader. We convert to pandas so the
+    # rest of the example is the same either way
+    sequence_bytes = (sequence if isinstance(sequence, bytes)
+                      else sequence.encode())
+    df = pl.read_csv(sequence_bytes, separator='\t',
+                     schema_overrides={col: pl.Int32
+                                       for col in sequence_dtypes}).to_pandas()
+else:
+    sequence_buf = (BytesIO(sequence) if isinstance(sequence, bytes)
+                    else StringIO(sequence))
+    df = pd.read_csv(sequence_buf, sep='\t', engine='c',
+                     dtype=sequence_dtypes)
 print(df)
 
 # Let's create a new sequence file
@@ -66,8 +94,8 @@ with open(new_sequence_file_name, 'w') as fp:
     # humans, so the ordering of the seqeuence file is enforced and not
     # dependent on this header in the current iteration
     date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    fp.write(f"# Sequence file example generated {date}\n")
-    fp.write('Awell\tAelec\tBwell\tBelec\tMwell\tMelec\tNwell\tNelec\n')
+    lines = [f"# Sequence file example generated {date}\n",
+             'Awell\tAelec\tBwell\tBelec\tMwell\tMelec\tNwell\tNelec\n']
     # Here is a hardcoded sequence as a list of tuples, but you could
     # programmatically generate one or someting. In this example, there are
     # only two
@@ -76,8 +104,12 @@ with open(new_sequence_file_name, 'w') as fp:
     # sequence file. This is simpler for an example.
     sequence = [(1, 1, 1, 10, 1, 4, 1, 17),
                 (1, 1, 1, 10, 1, 4, 1, 17)]
-    for s in sequence:
-        fp.write("\t".join([str(x) for x in s]) + "\n")
+    # Format every row up front and hand the whole file to a single
+    # writelines call. The rows are all integers so one printf style format
+    # per row does the conversion
+    row_fmt = "\t".join(["%d"] * 8) + "\n"
+    lines.extend(row_fmt % s for s in sequence)
+    fp.writelines(lines)
 
 # The rest of the example requires that the device is connected
 if device.connected == False:
@@ -132,7 +164,7 @@ pretty_list(sequences)
 
 # We should have the sequence we uploaded, let's check. Note that the sequences
 # reutrned here do not have an extension
-sequence_file = '.'.join(new_sequence_file_name.split('.')[:-1])
+sequence_file = os.path.splitext(new_sequence_file_name)[0]
 assert sequence_file in sequences
 
 # Now we can collect the sequence. We collect sequences as part of named
@@ -153,10 +185,11 @@ dev_api.call("start_resistivity_acquisition",
 # We can monitor progress by getting the acquisition log. This is an event api
 # endpoint, which means that the call is a generator that yields log messages as
 # they are generated. This is a blocking call, so it will not return until the
-# acquisition is complete.
+# acquisition is complete. Each message is flushed so progress shows up as it
+# happens, even when the output is piped
 
 for log in dev_api.event("get_acquisition_log"):
-    print(log, end='')
+    print(log, end='', flush=True)
 
 # Acquisition file names are based on the survey name and the time the
 # acquisition was started. We can get the file name by listing the acquisitions
@@ -180,10 +213,11 @@ dev_api.call("mark_acquisition_to_upload",
 
 # Now we wait for the acquisition to upload, then we can download it
 print("Waiting for device data to sync. This can take a bit")
+acquisition_file = f"{acquisition_name}.csv"
 for event in event_monitor:
     print(event)
     if event['event'] == 'sync_from':
-        if event['msg'].endswith(f"{acquisition_name}.csv"):
+        if event['msg'].endswith(acquisition_file):
             break
 print("Synced from device")
 print("Downloading acquisition data")
@@ -194,22 +228,41 @@ print("Here are the existing files in the survey directory")
 pretty_list(survey_files)
 # Download the acquisition data
 
-acquisition_file = f"{acquisition_name}.csv"
 device.get_file(f'data/{survey_name}/ert/{acquisition_file}', acquisition_file)
 print("Done downloading acquisition data")
+# pyarrow is optional as well, it is used for the acquisition data which can be
+# large
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pacsv = None
 # Now we can load the data into a pandas dataframe and plot it, but only after
-# stripping the metadata
-clean_acquisition_file = f"{acquisition_name}_no_metadata.csv"
-with open(acquisition_file) as fp, open(clean_acquisition_file, 'w') as fp_out:
-    lines = fp.readlines()
-    found_header = False
-    for line in lines:
-        if line.startswith('timestamp'):
-            # We found the header
-            found_header = True
-        if found_header:
-            fp_out.write(line)
-df = pd.read_csv(clean_acquisition_file)
+# skipping the metadata. We find the byte offset of the header line by
+# scanning a memory map of the file, then read from there rather than writing
+# out a stripped copy of the file
+with open(acquisition_file, 'rb') as fp:
+    with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:9] == b'timestamp':
+            header_offset = 0
+        else:
+            # The header is at the start of a line. If it is not found at all,
+            # find() returns -1 and we read from the start of the file
+            header_offset = mm.find(b'\ntimestamp') + 1
+        if pacsv is not None:
+            # pyarrow can parse the mapped pages in place, so the data goes
+            # straight from the page cache into columnar buffers with multiple
+            # threads, and ArrowDtype keeps the columns backed by them. The
+            # view must be released before the map is closed
+            with memoryview(mm) as view:
+                table = pacsv.read_csv(
+                    pa.BufferReader(pa.py_buffer(view[header_offset:])),
+                    read_options=pacsv.ReadOptions(block_size=8 << 20,
+                                                   use_threads=True))
+            df = table.to_pandas(types_mapper=pd.ArrowDtype)
+    if pacsv is None:
+        fp.seek(header_offset)
+        df = pd.read_csv(fp)
 print(df.head())
 print("Done")
 
@@ -232,7 +285,6 @@ dev_api.call('discard_acquisition', survey_name=survey_name,
 # Remove local files
 os.remove(new_sequence_file_name)
 os.remove(acquisition_file)
-os.remove(clean_acquisition_file)
 # We can close the device api handle
 dev_api.close()
 # Finally, we can close the event monitor
@@ -4,21 +4,24 @@
 """
 Subpackage for SSI IOT API CLient
 """
-from ssi.api_client import ApiClient
+# ssi.api_client (and with it requests), websocket and tabulate are imported
+# where they are first used. This keeps importing the module, and CLI paths
+# such as --help or argument errors, from paying for them up front
 from beartype import beartype
-from typing import Optional, List, Dict
-from tabulate import tabulate
+from typing import Optional, List, Dict, Callable, NamedTuple
 import argparse
 import sys
 import os
 import time
 import enum
-import json
 import threading
 import queue
-import websocket
+import collections
+import itertools
+import concurrent.futures
+import json
 
-class DeviceApiEndpointType(enum.Enum):
+class DeviceApiEndpointType(enum.IntEnum):
     """
     Possible call types for device api calls
     """
@@ -29,6 +32,11 @@ class DeviceApiException(Exception):
     pass
 
 class DeviceApi():
+    # Number of message slots. Must be a power of two so a message id maps to
+    # its slot with a mask. This bounds the number of outstanding calls and
+    # open event streams per handle
+    _MSG_SLOTS = 1024
+
     @beartype
     def __init__(self, device: "Device", ws):
         self._device = device
@@ -36,9 +44,14 @@ class DeviceApi():
         self._endpoints = {
             "get_call_info": (0, DeviceApiEndpointType.CALL),
             }
-        self._last_message_id = 0
-        self._msg_queues = {}
-        self._running = True
+        # Calling next on a count is a single step under the GIL, so message
+        # ids stay unique even when calls are made from several threads
+        self._next_message_id = itertools.count(1).__next__
+        # Fixed ring of slots indexed by message id. Each slot holds the full
+        # message id so that a late reply for an id which wrapped onto a reused
+        # slot is not handed to the wrong consumer
+        self._msg_queues = [None] * self._MSG_SLOTS
+        self._stop = threading.Event()
         self._msg_router_thread = threading.Thread(target=self._msg_router, daemon=True)
         self._msg_router_thread.start()
         endpoints = self.call('get_call_info')
@@ -51,6 +64,11 @@ class DeviceApi():
             elif (type_str == 'event'):
                 type_enum = DeviceApiEndpointType.EVENT
             self._endpoints[endpoints['endpoints'][i]] = (i, type_enum)
+        # Endpoints are fixed once discovered, so split them by type up front
+        self._calls = [k for k, (_, endpoint_type) in self._endpoints.items()
+                       if endpoint_type == DeviceApiEndpointType.CALL]
+        self._events = [k for k, (_, endpoint_type) in self._endpoints.items()
+                        if endpoint_type == DeviceApiEndpointType.EVENT]
     def __enter__(self):
         return self
 
@@ -58,29 +76,44 @@ class DeviceApi():
         self.close()
 
     def _msg_router(self):
-        while self._running:
+        import websocket
+        while not self._stop.is_set():
             try:
                 msg = self._ws.recv_json()
             except websocket._exceptions.WebSocketConnectionClosedException as e:
-                if self._running:
-                    self._running = False
+                if not self._stop.is_set():
+                    self._stop.set()
                     raise DeviceApiException("Connection closed") from e
                 return
-            if 'message_id' not in msg:
+            # This runs for every frame, so look each key up only once
+            msg_id = msg.get('message_id')
+            if msg_id is None:
                 continue
-            if msg['message_id'] not in self._msg_queues:
-                print("Got message for unknown message id: %d" % msg['message_id'])
+            slot = self._msg_queues[msg_id & (self._MSG_SLOTS - 1)]
+            if slot is None or slot[0] != msg_id:
+                print("Got message for unknown message id: %d" % msg_id)
                 continue
-            self._msg_queues[msg['message_id']].put(msg)
+            _, msgs, ready = slot
+            msgs.append(msg)
+            ready.set()
 
     def _send_msg(self, endpoint: str, **kwargs):
         if endpoint not in self._endpoints:
             raise Exception("Invalid endpoint")
         endpoint_id = self._endpoints[endpoint][0]
         payload = kwargs
-        self._last_message_id += 1
-        msg_id = self._last_message_id
-        self._msg_queues[msg_id] = queue.Queue()
+        # Skip over slots which are still in use, for example by a long
+        # running event stream
+        for _ in range(self._MSG_SLOTS):
+            msg_id = self._next_message_id()
+            if self._msg_queues[msg_id & (self._MSG_SLOTS - 1)] is None:
+                break
+        else:
+            raise DeviceApiException("Too many outstanding messages")
+        # Each message id has exactly one consumer, so a deque plus an event
+        # to wake it is all we need rather than a fully locked queue
+        self._msg_queues[msg_id & (self._MSG_SLOTS - 1)] = (
+            msg_id, collections.deque(), threading.Event())
         self._ws.send_json({
             "endpoint_id": endpoint_id,
             "payload": payload,
@@ -88,15 +121,39 @@ class DeviceApi():
             })
         return msg_id
 
+    def _recv_msg(self, msg_id: int, timeout=None):
+        """
+        Waits for and returns the next message for the given message id.
+        Raises queue.Empty if nothing arrives within the timeout
+        """
+        _, msgs, ready = self._msg_queues[msg_id & (self._MSG_SLOTS - 1)]
+        while not msgs:
+            if not ready.wait(timeout):
+                raise queue.Empty
+            # Clear before re-checking so a message appended after the check
+            # still leaves the event set for the next wait
+            ready.clear()
+        return msgs.popleft()
+
+    def _release_msg(self, msg_id: int):
+        """
+        Frees the slot of a message id which will not be read from again
+        """
+        self._msg_queues[msg_id & (self._MSG_SLOTS - 1)] = None
+
     @beartype
     def call(self, endpoint: str, as_json: bool = True, timeout=None, **kwargs):
         if self._endpoints[endpoint][1] != DeviceApiEndpointType.CALL:
             raise Exception("Invalid endpoint type")
         else:
             msg_id = self._send_msg(endpoint, **kwargs)
-            timeout = 5
-            ret = self._msg_queues[msg_id].get(timeout=timeout)
-            del self._msg_queues[msg_id]
+            if timeout is None:
+                timeout = 5
+            try:
+                ret = self._recv_msg(msg_id, timeout)
+            finally:
+                # Free the slot even if we timed out so it can be reused
+                self._release_msg(msg_id)
             if ret['status_code'] != 0:
                 raise DeviceApiException(ret['payload'])
             if as_json:
@@ -112,28 +169,31 @@ class DeviceApi():
             raise Exception("Invalid endpoint type")
         else:
             msg_id = self._send_msg(endpoint, **kwargs)
-            while True:
-                ret = self._msg_queues[msg_id].get()
-                if ret['status_code'] == 0xFFFF:
-                    del self._msg_queues[msg_id]
-                    break
-                if ret['status_code'] != 0:
-                    raise DeviceApiException(ret['payload'])
-                if as_json:
-                    yield json.loads(ret['payload'])
-                else:
-                    yield ret['payload']
+            try:
+                while True:
+                    ret = self._recv_msg(msg_id)
+                    if ret['status_code'] == 0xFFFF:
+                        break
+                    if ret['status_code'] != 0:
+                        raise DeviceApiException(ret['payload'])
+                    if as_json:
+                        yield json.loads(ret['payload'])
+                    else:
+                        yield ret['payload']
+            finally:
+                # Also runs when the consumer stops early and the generator
+                # is closed or collected, otherwise the slot stays taken
+                self._release_msg(msg_id)
 
     def get_calls(self):
-        return [k for k in self._endpoints.keys() if self._endpoints[k][1] ==
-                DeviceApiEndpointType.CALL]
+        return list(self._calls)
 
     def get_events(self):
-        return [k for k in self._endpoints.keys() if self._endpoints[k][1] ==
-                DeviceApiEndpointType.EVENT]
+        return list(self._events)
 
     def close(self):
-        self._running = False
+        self._stop.set()
+        # Closing the socket unblocks the router if it is waiting on a frame
         self._ws.close()
         self._msg_router_thread.join()
 
@@ -142,6 +202,12 @@ class Device():
     Represents a device in the SSI IOT Stack and expose data and operations
     which are related to it
     """
+    # Attributes which are read often, for example by __repr__ and the CLI
+    # listings. Once known they are copied onto the instance so that normal
+    # attribute lookup finds them without going through __getattr__
+    _HOT_ATTRIBS = ('hostname', 'device_id', 'type', 'connected',
+                    'heartbeat_utc', 'serial')
+
     @beartype
     def _init(self, key, val):
         self.__dict__[key] = val
@@ -155,10 +221,9 @@ class Device():
         # in that they are understood by the IOT stack. They include things
         # LIKE the hostname, serial, and so forth. These may be lazy loaded or
         # they may be initialzied
-        self._init('_attribs', attribs)
-        if self._attribs and "properties" in self._attribs:
-            self._props = self._attribs['properties']
-            del self._attribs['properties']
+        for key in self._HOT_ATTRIBS:
+            self.__dict__.pop(key, None)
+        self._set_attribs(attribs)
         # A dictionary of configurations. Configurations are JSON files which
         # are synced with the device to control certian device behvaiors. The
         # specific kidns of configurations that are pushed/pulled depend on the
@@ -171,6 +236,20 @@ class Device():
         # Same as above except for status files
         self._init('_statuses', {})
 
+    def _set_attribs(self, attribs: Optional[Dict]):
+        """
+        Stores the attributes, splitting out the properties if they were
+        included and caching the hot attributes on the instance
+        """
+        self._init('_attribs', attribs)
+        if attribs is None:
+            return
+        if 'properties' in attribs:
+            self._init('_props', attribs.pop('properties'))
+        for key in self._HOT_ATTRIBS:
+            if key in attribs:
+                self._init(key, attribs[key])
+
     def refresh(self):
         """
         Clear locally stored data about the device, forcing a refetch from the
@@ -184,6 +263,9 @@ class Device():
         """
         Takes the device_id and the api client handle.
         """
+        self._setup(device_id, api_client, attribs)
+
+    def _setup(self, device_id, api_client, attribs):
         # The device ID is always set
         self._init('id', device_id)
         # The API handle
@@ -193,6 +275,16 @@ class Device():
         self._init('_ro', False)
         self._reset(attribs)
 
+    @classmethod
+    def _from_info(cls, api_client: 'IotApiClient', attribs: Dict):
+        """
+        Builds a device from a listing row which includes its info. This skips
+        the argument checking of __init__, which adds up over large listings
+        """
+        device = cls.__new__(cls)
+        device._setup(attribs['device_id'], api_client, attribs)
+        return device
+
     def __repr__(self):
         return f"<Device device_id={self.id} hostname={self.hostname}>"
 
@@ -260,8 +352,7 @@ class Device():
         Removes a configuration file from the device
         """
         self._raise_if_ro()
-        if file in self._configs:
-           del self._configs[file]
+        self._configs.pop(file, None)
         self.api(f"iot/set_device_config?config_name={file}", method="DELETE")
 
     def create_config(self, file: str, config: Optional[Dict] = None):
@@ -281,8 +372,7 @@ class Device():
         Replaces a configuration file on the device
         """
         self._raise_if_ro()
-        if file in self._configs:
-           del self._configs[file]
+        self._configs.pop(file, None)
         self.api(
             f"iot/set_device_config?config_name={file}",
             config,
@@ -302,9 +392,9 @@ class Device():
         """
         if file in self._configs and not refresh:
             return self._configs[file]
-        self._configs[file] = self.api(
-            "iot/get_device_config", {'config_name': file})
-        return self.get_config(file)
+        config = self.api("iot/get_device_config", {'config_name': file})
+        self._configs[file] = config
+        return config
 
     def _raise_if_ro(self):
         if self._ro:
@@ -317,8 +407,7 @@ class Device():
         device. If the file does not exist, then it is created.
         """
         self._raise_if_ro()
-        if file in self._configs:
-           del self._configs[file]
+        self._configs.pop(file, None)
         return self.api(f"iot/set_device_config?config_name={file}", {key_name:
                                                                       value},
                         method="PATCH")
@@ -331,8 +420,7 @@ class Device():
         exact behavior is specific to the software which uses the config file.
         """
         self._raise_if_ro()
-        if file in self._configs:
-            del self._configs[file]
+        self._configs.pop(file, None)
         # TODO double check the semantics of this
         return self.api(
             f"iot/set_device_config?config_name={file}", {key_name: None}, method="PATCH")
@@ -360,10 +448,11 @@ class Device():
         are provided by the IotApiClient in bulk. This does a single query
         based on the device id
         """
-        self._attribs = self.api("iot/get_device_info", {'with_props': True})
-        if 'properties' in self._attribs:
-            self._props = self._attribs['properties']
-            del self._attribs['properties']
+        attribs = self.api("iot/get_device_info", {'with_props': True})
+        # We asked for the properties, so if none came back the device has
+        # none. Recording that avoids refetching on every get_prop
+        attribs.setdefault('properties', {})
+        self._set_attribs(attribs)
 
     def __getattr__(self, key):
         if key in self.__dict__:
@@ -394,25 +483,33 @@ class Device():
         """
         Converts a number of seconds to a human readable string
         """
-        ret = ""
-        if seconds > 86400:
-            ret += f"{int(seconds // 86400)}d "
-            seconds %= 86400
-        if seconds > 3600:
-            ret += f"{int(seconds // 3600)}h "
-            seconds %= 3600
-        if seconds > 60:
-            ret += f"{int(seconds // 60)}m "
-            seconds %= 60
-        if seconds > 0:
-            ret += f"{int(seconds)}s "
-        return ret.strip()
-
-    def to_human_dict(self):
+        # A heartbeat slightly in the future from clock skew counts as now
+        days, seconds = divmod(max(int(seconds), 0), 86400)
+        hours, seconds = divmod(seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        parts = []
+        if days:
+            parts.append(f"{days}d")
+        if hours:
+            parts.append(f"{hours}h")
+        if minutes:
+            parts.append(f"{minutes}m")
+        if seconds or not parts:
+            parts.append(f"{seconds}s")
+        return ' '.join(parts)
+
+    def to_human_dict(self, now: Optional[float] = None):
+        """
+        Returns a summary of the device for display. now is the current time
+        used for the heartbeat age, so callers formatting many devices can
+        pass it in once
+        """
+        if now is None:
+            now = time.time()
         d = self.to_dict()
         last_heartbeat = d.get('heartbeat_utc')
         if last_heartbeat:
-            delta = self.seconds_to_human(time.time() - last_heartbeat)
+            delta = self.seconds_to_human(now - last_heartbeat)
         else:
             delta = "never"
         human_dict = {
@@ -437,21 +534,38 @@ class Device():
         """
         self._ro = True
 
+    def _setattr_hostname(self, value):
+        self.api("iot/set_device_hostname", {'hostname': value})
+        self._api._forget_device(self)
+        self.refresh()
+
+    def _setattr_type(self, value):
+        self.api("iot/set_device_type", {'type': value})
+        self.refresh()
+
+    def _setattr_serial(self, value):
+        raise RuntimeError("Modifying 'serial' is currently not supported")
+
+    def _setattr_location(self, value):
+        self.api("iot/update_device_location", {'lat': value[0],
+                                                'lon': value[1]})
+        self.refresh()
+
+    # Attributes which are understood by the IOT stack and are set through
+    # their own API calls rather than as properties
+    _SETATTR_HANDLERS = {
+        'hostname': _setattr_hostname,
+        'type': _setattr_type,
+        'serial': _setattr_serial,
+        'location': _setattr_location,
+    }
+
     def __setattr__(self, key, value):
         self._raise_if_ro()
-        if key == "hostname":
-            self.api("iot/set_device_hostname", {'hostname': value})
-            self.refresh()
-        elif key == "type":
-            self.api("iot/set_device_type", {'type': value})
-            self.refresh()
-        elif key == "serial":
-            raise RuntimeError("Modifying 'serial' is currently not supported")
-        elif key == "location":
-            self.api("iot/update_device_location", {'lat': value[0],
-                                                    'lon': value[1]})
-            self.refresh()
-        elif key in self.__dict__:
+        handler = self._SETATTR_HANDLERS.get(key)
+        if handler is not None:
+            handler(self, value)
+        elif key in self.__dict__ and key not in self._HOT_ATTRIBS:
             self.__dict__[key] = value
         else:
             self.set_prop(key, value)
@@ -468,7 +582,7 @@ class Device():
         """
         args = {}
         if limit:
-            args['limit'] = limi
+            args['limit'] = limit
         if kind:
             args['events'] = kind.split(',')
         return self.api("iot/get_device_events", args)
@@ -532,7 +646,10 @@ class Device():
         Sets the device hostname
         """
         self._raise_if_ro()
-        return self.api("iot/set_device_hostname", {'hostname': hostname})
+        ret = self.api("iot/set_device_hostname", {'hostname': hostname})
+        self._api._forget_device(self)
+        self.refresh()
+        return ret
 
     def set_project(self, project_id: int):
         """
@@ -574,10 +691,10 @@ class Device():
         resp = self._api(f'iot/device/fs/{device_id}/{path}',
                          raw_response=True, method='GET', stream=True)
         self._api.api.check_status_error(resp, 'iot/device/fs')
+        # Use large chunks so big files don't cost a Python iteration and a
+        # write call per KiB
         with open(local_path, 'wb') as f:
-            for chunk in resp.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
+            f.writelines(resp.iter_content(chunk_size=262144))
 
     @beartype
     def put_file_data(self, path: str, data: bytes, overwrite: bool = False):
@@ -585,6 +702,22 @@ class Device():
         Puts a file on the device from data
         """
         self._raise_if_ro()
+        self._put_file_body(path, data, overwrite)
+
+    @beartype
+    def put_file_data_stream(self, path: str, fp, overwrite: bool = False):
+        """
+        Puts a file on the device from a binary file object. The body is
+        streamed from the file object rather than read into memory first
+        """
+        self._raise_if_ro()
+        self._put_file_body(path, fp, overwrite)
+
+    def _put_file_body(self, path: str, data, overwrite: bool):
+        """
+        Uploads a request body to a device file path. data is anything
+        requests accepts as a body, either bytes or a file object
+        """
         device_id = self.device_id
         resp = self._api(f'iot/device/fs/{device_id}/{path}', method='HEAD',
                          raw_response=True)
@@ -604,7 +737,7 @@ class Device():
         """
         self._raise_if_ro()
         with open(local_path, 'rb') as f:
-            self.put_file_data(path, f.read(), overwrite)
+            self.put_file_data_stream(path, f, overwrite)
 
     @beartype
     def ls(self, path:str):
@@ -618,10 +751,10 @@ class Device():
         self._api.api.check_status_error(resp, 'iot/device/fs')
         file_list = resp.json()
         assert isinstance(file_list, list)
-        assert(file_list[0].get('name'))
-        # Remove index field
+        assert not file_list or file_list[0].get('name')
+        # Remove index field in place, tolerating listings without it
         for f in file_list:
-            del f['index']
+            f.pop('index', None)
         return file_list
 
     @beartype
@@ -642,37 +775,89 @@ class IotApiClient():
     performing operations on them
     """
     @beartype
-    def __init__(self, url: Optional[str] = None, token: Optional[str] = None):
+    def __init__(self, url: Optional[str] = None, token: Optional[str] = None,
+                 device_cache_ttl: Optional[int] = None):
+        """
+        device_cache_ttl enables reusing which device a hostname or fuzzy
+        lookup resolved to for that many seconds. It is off by default since
+        a device renamed by another client keeps resolving to the old one
+        until the entry expires
+        """
         if not url and not os.environ.get('SSI_API_URL'):
             url = "https://things.subsurfaceinsights.com/"
+        from ssi.api_client import ApiClient
         self.api = ApiClient(url=url, token=token)
+        self._device_cache_ttl = device_cache_ttl
+        # Lookup key => (expiry time, device id) for recently resolved devices
+        self._device_cache = {}
+
+    def _cached_device(self, key: tuple):
+        """
+        Returns a new handle for the device a lookup resolved to, or None
+        """
+        entry = self._device_cache.get(key)
+        if entry is None:
+            return None
+        expires, device_id = entry
+        if expires < time.monotonic():
+            del self._device_cache[key]
+            return None
+        # Only the id is kept so that callers never share a Device, whose
+        # state such as being read only is per handle
+        return Device(device_id, self)
+
+    def _cache_device(self, key: tuple, device: Device):
+        if self._device_cache_ttl:
+            self._device_cache[key] = (
+                time.monotonic() + self._device_cache_ttl, device.id)
+
+    def _forget_device(self, device: Device):
+        """
+        Drops cached lookups which resolved to the given device, for example
+        after its hostname changed
+        """
+        self._device_cache = {key: entry for key, entry in
+                              self._device_cache.items()
+                              if entry[1] != device.id}
 
     def __call__(self, func, **kwargs):
         return self.api(func, **kwargs)
 
     @beartype
     def _id_to_device_obj(self, device_id: int):
-        pass
+        return Device(device_id, self)
 
     @beartype
     def _device_dict_to_device_obj(self, device: dict):
-        pass
+        return Device._from_info(self, device)
+
+    def _to_device_objs(self, devices: list):
+        """
+        Converts a device listing to device objects. Listings requested with
+        info are dicts which preload the device attributes, otherwise they are
+        plain ids and the attributes are fetched lazily per device
+        """
+        return [Device._from_info(self, device)
+                if isinstance(device, dict)
+                else self._id_to_device_obj(device)
+                for device in devices]
 
     @beartype
     def get_devices_by_property(self, prop: str, value: str):
         devices = self.api("iot/get_devices_by_property",
                            {
                                'property': prop,
-                               'value': value
+                               'value': value,
+                               'with_info': True,
                            })
-        return [Device(device, self) for device in devices]
+        return self._to_device_objs(devices)
 
     @beartype
     def get_devices_by_project(self, project_subdomain: str):
         self.api.project = project_subdomain
-        devices = self.api("iot/list_devices")
+        devices = self.api("iot/list_devices", {'with_info': True})
         self.api.project = None
-        return [Device(device, self) for device in devices]
+        return self._to_device_objs(devices)
 
     def _generate_event(self, ws):
         while True:
@@ -680,11 +865,25 @@ class IotApiClient():
             if data:
                 yield data
 
-    @beartype
-    def gen_device_events(self, devices: Optional[List[Device]] = None, kind: Optional[List[str]] = None):
-        """
-        Returns a generator which yields events as they occur
-        """
+    async def _agenerate_event(self, ws):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        # The websocket is blocking, so receive on a thread of its own. The
+        # default executor is shared and small, so long lived streams there
+        # would starve each other and anything else using it
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        try:
+            while True:
+                data = await loop.run_in_executor(executor, ws.recv_json)
+                if data:
+                    yield data
+        finally:
+            # Closing the socket unblocks a receive still running on the thread
+            ws.close()
+            executor.shutdown(wait=False)
+
+    def _device_events_ws(self, devices: Optional[List[Device]] = None,
+                          kind: Optional[List[str]] = None):
         if devices is None:
             device_ids = [-1]
         else:
@@ -694,7 +893,23 @@ class IotApiClient():
         }
         if kind:
             args['kind'] = kind
-        return self._generate_event(self.api.ws("iot/device_events", args))
+        return self.api.ws("iot/device_events", args)
+
+    @beartype
+    def gen_device_events(self, devices: Optional[List[Device]] = None, kind: Optional[List[str]] = None):
+        """
+        Returns a generator which yields events as they occur
+        """
+        return self._generate_event(self._device_events_ws(devices, kind))
+
+    @beartype
+    def agen_device_events(self, devices: Optional[List[Device]] = None, kind: Optional[List[str]] = None):
+        """
+        Returns an async generator which yields events as they occur. Events
+        are monitored from when this is called, just like gen_device_events,
+        so several device streams can be consumed from one event loop
+        """
+        return self._agenerate_event(self._device_events_ws(devices, kind))
 
     @beartype
     def get_my_devices(self):
@@ -704,16 +919,16 @@ class IotApiClient():
         devices = self.api("iot/get_my_devices", {
             'with_info': True,
         });
-        return [Device(device['device_id'], self, device) for device in devices]
+        return [Device._from_info(self, device) for device in devices]
 
     @beartype
     def get_devices_by_user(self, user_id: int):
         """
         Returns a list of devices that belong to a user.
         """
-        devices = self.api("iot/list_devices", {'user_id': user_id})
-        #TODO Improve the efficiency of these queries by preloading attribs
-        return [Device(device, self) for device in devices]
+        devices = self.api("iot/list_devices", {'user_id': user_id,
+                                                'with_info': True})
+        return self._to_device_objs(devices)
 
     @beartype
     def get_device_by_hostname(self, hostname: str):
@@ -721,12 +936,17 @@ class IotApiClient():
         Returns a device handle by the given hostname. If there is no device by
         that hostname, then None is returned
         """
+        key = ('hostname', hostname)
+        cached = self._cached_device(key)
+        if cached:
+            return cached
         devices = self.api("iot/get_devices_by_hostname",
                            {'hostname': hostname})
         if devices:
             assert (len(devices) == 1)
-            device = devices[0]
-            return Device(device, self)
+            device = Device(devices[0], self)
+            self._cache_device(key, device)
+            return device
         return None
 
     @beartype
@@ -748,11 +968,21 @@ class IotApiClient():
         """
         device = self.api("iot/get_device_info", {'device_id': device_id})
         if device:
-            return Device(device['device_id'], self, device)
+            return self._device_dict_to_device_obj(device)
         return None
 
     @beartype
     def get_device_fuzzy(self, device: str):
+        key = ('fuzzy', device)
+        ret = self._cached_device(key)
+        if ret:
+            return ret
+        ret = self._get_device_fuzzy(device)
+        if ret:
+            self._cache_device(key, ret)
+        return ret
+
+    def _get_device_fuzzy(self, device: str):
         ret = None
         try:
             device_id = int(device)
@@ -775,8 +1005,7 @@ class IotApiClient():
         Returns all devices in the system
         """
         devices = self.api("iot/list_devices", {'with_info': True})
-        return [Device(device['device_id'], self, device)
-                for device in devices]
+        return [Device._from_info(self, device) for device in devices]
 
     @beartype
     def list_online_devices(self):
@@ -788,29 +1017,301 @@ class IotApiClient():
 
 
 def cli_display_result_from_json_table(result: dict):
+    from tabulate import tabulate
     print(tabulate(result['data'], headers=result['headers']))
 
 
 def cli_display_result(result):
+    from tabulate import tabulate
+    # Box drawing is only worth its cost for a person at a terminal
+    tablefmt = "fancy_outline" if sys.stdout.isatty() else "simple"
     if isinstance(result, list) and len(result) > 0:
         if isinstance(result[0], dict):
-            print(tabulate(result, headers="keys", tablefmt="fancy_outline"))
+            print(tabulate(result, headers="keys", tablefmt=tablefmt))
         else:
             print(result)
     elif isinstance(result, dict):
-        print(tabulate([result], headers="keys", tablefmt="fancy_outline"))
+        print(tabulate([result], headers="keys", tablefmt=tablefmt))
     else:
         print(result)
 
 
 def cli_display_devices(devices):
-    devices_table = [device.to_human_dict() for device in devices]
+    now = time.time()
+    devices_table = [device.to_human_dict(now) for device in devices]
     cli_display_result(devices_table)
 
 def cli_print_hostnames(devices):
     for device in devices:
         print(device.to_dict()['hostname'])
 
+def cli_resolve_device_with(args, api, paf_api, call: str, params: dict):
+    """
+    Resolves the device argument and makes a user/project API call, for
+    commands where neither depends on the other. Returns the device, or None
+    if it was not found, and the call result
+    """
+    if paf_api is api.api:
+        # The client is not known to be safe to use from two threads at once,
+        # so when both APIs share one the two requests are made in turn
+        device = api.get_device_fuzzy(args.device)
+        if not device:
+            return None, None
+        return device, paf_api(call, params)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        result = pool.submit(paf_api, call, params)
+        device = api.get_device_fuzzy(args.device)
+        if not device:
+            # A missing device is reported as such, whatever the call did
+            return None, None
+        return device, result.result()
+
+def cli_print_events(events):
+    # Write straight to stdout rather than through print for each event. The
+    # stream's own buffering still applies, so events show up as they arrive
+    # at a terminal and are written out in blocks when piped
+    write = sys.stdout.write
+    for event in events:
+        write(f"{event}\n")
+
+def cli_cmd_list(args, api, paf_api, device):
+    devices = api.list_devices()
+    if args.hostnames_only:
+        cli_print_hostnames(devices)
+    else:
+        cli_display_devices(devices)
+
+
+def cli_cmd_list_online(args, api, paf_api, device):
+    devices = api.list_online_devices()
+    if args.hostnames_only:
+        cli_print_hostnames(devices)
+    else:
+        cli_display_devices(devices)
+
+
+def cli_cmd_list_events(args, api, paf_api, device):
+    events = device.get_events(args.kind, args.limit)
+    cli_display_result_from_json_table(events)
+
+
+def cli_cmd_watch_events(args, api, paf_api, device):
+    events = device.gen_events()
+    cli_print_events(events)
+
+
+def cli_cmd_watch_all_events(args, api, paf_api, device):
+    events = api.gen_device_events()
+    cli_print_events(events)
+
+
+def cli_cmd_mapped_ports(args, api, paf_api, device):
+    ports = device.get_mapped_ports()
+    cli_display_result(ports)
+
+
+def cli_cmd_map_port(args, api, paf_api, device):
+    port = device.map_port(args.remote_port, args.remote_host)
+    print(port['local_port'])
+
+
+def cli_cmd_unmap_port(args, api, paf_api, device):
+    device.unmap_port(args.local_port)
+
+
+def cli_cmd_gen_ssh_host_config(args, api, paf_api, device):
+    port = device.map_port(22, 'localhost')['local_port']
+    print(f"""Host {device.hostname}
+  HostName localhost
+  Port {port}
+  User pi
+  ProxyJump things.int.subsurfaceinsights.com
+""")
+
+
+def cli_cmd_set_type(args, api, paf_api, device):
+    device.set_type(args.type)
+
+
+def cli_cmd_set_hostname(args, api, paf_api, device):
+    device.set_hostname(args.hostname)
+
+
+def cli_cmd_set_project(args, api, paf_api, device):
+    device, project = cli_resolve_device_with(
+        args, api, paf_api, "project/v2/get_project_by_subdomain",
+        {"subdomain": args.project})
+    if not device:
+        print("No device found")
+        return 1
+    device.set_project(project['paf_project_id'])
+
+
+def cli_cmd_add_admin(args, api, paf_api, device):
+    device, user = cli_resolve_device_with(
+        args, api, paf_api, "user/v2/get_user_by_email",
+        {"paf_user_email": args.email})
+    if not device:
+        print("No device found")
+        return 1
+    device.add_admin(user["paf_user_id"])
+
+
+def cli_cmd_remove_admin(args, api, paf_api, device):
+    device, user = cli_resolve_device_with(
+        args, api, paf_api, "user/v2/get_user_by_email",
+        {"paf_user_email": args.email})
+    if not device:
+        print("No device found")
+        return 1
+    device.remove_admin(user["paf_user_id"])
+
+
+def cli_cmd_list_admins(args, api, paf_api, device):
+    from ssi.api_client import ApiClient
+    admins = device.list_admins()
+    # There is no bulk lookup, so issue the per-user lookups concurrently
+    # rather than paying a round trip for each one in turn. A client is not
+    # known to be safe to use from several threads at once, so each worker
+    # makes its own
+    local = threading.local()
+    def get_user(user_id):
+        if not hasattr(local, 'api'):
+            local.api = ApiClient(url=args.user_project_url, token=args.token)
+        return local.api("user/v2/get_user_by_id", {"paf_user_id": user_id})
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+        users = list(pool.map(get_user, admins))
+    cli_display_result(users)
+
+
+def cli_cmd_list_statuses(args, api, paf_api, device):
+    events = device.get_status_files()
+    cli_display_result(events)
+
+
+def cli_cmd_get_status(args, api, paf_api, device):
+    status = device.get_status(args.status)
+    cli_display_result(status)
+
+
+def cli_cmd_list_configs(args, api, paf_api, device):
+    configs = device.get_config_files()
+    cli_display_result(configs)
+
+
+def cli_cmd_get_config(args, api, paf_api, device):
+    config = device.get_config(args.config)
+    cli_display_result(config)
+
+
+class CliCommand(NamedTuple):
+    """
+    A CLI command. arguments are the arguments of its subparser as (name,
+    add_argument keyword arguments) pairs. needs_device is set when the
+    handler needs the device argument resolved to a Device first, needs_paf
+    when it uses the user/project API
+    """
+    handler: Callable
+    arguments: list
+    needs_device: bool = False
+    needs_paf: bool = False
+
+
+CLI_COMMANDS = {
+    "list": CliCommand(cli_cmd_list, [
+        ("--hostnames-only", {"action": "store_true"}),
+    ]),
+    "list-online": CliCommand(cli_cmd_list_online, [
+        ("--hostnames-only", {"action": "store_true"}),
+    ]),
+    "list-events": CliCommand(cli_cmd_list_events, [
+        ("device", {"type": str}),
+        ("--kind", {"type": str,
+                    "help": "Comma separated string of events to list"}),
+        ("--limit", {"type": int, "default": 10}),
+    ], needs_device=True),
+    "watch-events": CliCommand(cli_cmd_watch_events, [
+        ("device", {"type": str, "default": None}),
+        ("--kind", {"type": str,
+                    "help": "Comma separated string of events to watch"}),
+        ("--limit", {"type": int, "default": 10}),
+    ], needs_device=True),
+    "watch-all-events": CliCommand(cli_cmd_watch_all_events, []),
+    "mapped-ports": CliCommand(cli_cmd_mapped_ports, [
+        ("device", {"type": str}),
+    ], needs_device=True),
+    "map-port": CliCommand(cli_cmd_map_port, [
+        ("device", {"type": str}),
+        ("remote_port", {"type": int}),
+        ("remote_host", {"type": str}),
+    ], needs_device=True),
+    "unmap-port": CliCommand(cli_cmd_unmap_port, [
+        ("device", {"type": str}),
+        ("local_port", {"type": int}),
+    ], needs_device=True),
+    "gen-ssh-host-config": CliCommand(cli_cmd_gen_ssh_host_config, [
+        ("device", {"type": str}),
+    ], needs_device=True),
+    "set-type": CliCommand(cli_cmd_set_type, [
+        ("device", {"type": str}),
+        ("type", {"type": str}),
+    ], needs_device=True),
+    "set-hostname": CliCommand(cli_cmd_set_hostname, [
+        ("device", {"type": str}),
+        ("hostname", {"type": str}),
+    ], needs_device=True),
+    "set-project": CliCommand(cli_cmd_set_project, [
+        ("device", {"type": str}),
+        ("project", {"type": str}),
+    ], needs_paf=True),
+    "add-admin": CliCommand(cli_cmd_add_admin, [
+        ("device", {"type": str}),
+        ("email", {"type": str}),
+    ], needs_paf=True),
+    "remove-admin": CliCommand(cli_cmd_remove_admin, [
+        ("device", {"type": str}),
+        ("email", {"type": str}),
+    ], needs_paf=True),
+    "list-admins": CliCommand(cli_cmd_list_admins, [
+        ("device", {"type": str}),
+    ], needs_device=True, needs_paf=True),
+    "list-statuses": CliCommand(cli_cmd_list_statuses, [
+        ("device", {"type": str}),
+    ], needs_device=True),
+    "get-status": CliCommand(cli_cmd_get_status, [
+        ("device", {"type": str}),
+        ("status", {"type": str}),
+    ], needs_device=True),
+    "list-configs": CliCommand(cli_cmd_list_configs, [
+        ("device", {"type": str}),
+    ], needs_device=True),
+    "get-config": CliCommand(cli_cmd_get_config, [
+        ("device", {"type": str}),
+        ("config", {"type": str}),
+    ], needs_device=True),
+}
+
+
+def cli_command_from_argv(argv: List[str]):
+    """
+    Finds the command in the arguments without parsing them by skipping the
+    global options, which all take a value. Returns None if help was asked for
+    or there is no command
+    """
+    argv = iter(argv)
+    for arg in argv:
+        if arg in ("-h", "--help"):
+            return None
+        if arg == "--":
+            return next(argv, None)
+        if arg.startswith("-"):
+            if "=" not in arg:
+                next(argv, None)
+            continue
+        return arg
+    return None
+
+
 def cli_tool():
     parser = argparse.ArgumentParser()
     parser.add_argument("--url", default=None)
@@ -819,159 +1320,39 @@ def cli_tool():
     parser.add_argument("--project", default=None)
     subparsers = parser.add_subparsers(dest="command")
     subparsers.required = True
-    parser_list = subparsers.add_parser("list")
-    parser_list.add_argument("--hostnames-only", action="store_true");
-    parser_list_online = subparsers.add_parser("list-online")
-    parser_list_online.add_argument("--hostnames-only", action="store_true");
-    parser_events = subparsers.add_parser("list-events")
-    parser_events.add_argument("device", type=str)
-    # parser_events.add_argument("device", type=str, nargs="+")
-    parser_events.add_argument("--kind", type=str, help="Comma separated string of events to list")
-    parser_events.add_argument("--limit", type=int, default=10)
-    parser_events_watch = subparsers.add_parser("watch-events")
-    parser_events_watch.add_argument("device", type=str, default=None)
-    # parser_events_watch.add_argument("device", type=str, nargs="+")
-    parser_events_watch.add_argument("--kind", type=str, help="Comma separated string of events to watch")
-    parser_events_watch.add_argument("--limit", type=int, default=10)
-    subparsers.add_parser("watch-all-events")
-    parser_mapped_ports = subparsers.add_parser("mapped-ports")
-    parser_mapped_ports.add_argument("device", type=str)
-    parser_map_port = subparsers.add_parser("map-port")
-    parser_map_port.add_argument("device", type=str)
-    parser_map_port.add_argument("remote_port", type=int)
-    parser_map_port.add_argument("remote_host", type=str)
-    parser_unmap_port = subparsers.add_parser("unmap-port")
-    parser_unmap_port.add_argument("device", type=str)
-    parser_unmap_port.add_argument("local_port", type=int)
-    parser_gen_ssh_host_config = subparsers.add_parser("gen-ssh-host-config")
-    parser_gen_ssh_host_config.add_argument("device", type=str)
-    parser_set_type = subparsers.add_parser("set-type")
-    parser_set_type.add_argument("device", type=str)
-    parser_set_type.add_argument("type", type=str)
-    parser_set_hostname = subparsers.add_parser("set-hostname")
-    parser_set_hostname.add_argument("device", type=str)
-    parser_set_hostname.add_argument("hostname", type=str)
-    parser_set_project = subparsers.add_parser("set-project")
-    parser_set_project.add_argument("device", type=str)
-    parser_set_project.add_argument("project", type=str)
-    parser_add_admin = subparsers.add_parser("add-admin")
-    parser_add_admin.add_argument("device", type=str)
-    parser_add_admin.add_argument("email", type=str)
-    parser_remove_admin = subparsers.add_parser("remove-admin")
-    parser_remove_admin.add_argument("device", type=str)
-    parser_remove_admin.add_argument("email", type=str)
-    parser_list_admins = subparsers.add_parser("list-admins")
-    parser_list_admins.add_argument("device", type=str)
-    parser_list_statuses = subparsers.add_parser("list-statuses")
-    parser_list_statuses.add_argument("device", type=str)
-    parser_get_status = subparsers.add_parser("get-status")
-    parser_get_status.add_argument("device", type=str)
-    parser_get_status.add_argument("status", type=str)
-    parser_list_configs = subparsers.add_parser("list-configs")
-    parser_list_configs.add_argument("device", type=str)
-    parser_get_config = subparsers.add_parser("get-config")
-    parser_get_config.add_argument("device", type=str)
-    parser_get_config.add_argument("config", type=str)
+    # Only build the subparser for the command being run. Everything is
+    # registered when the command is unknown or missing so that help and
+    # errors list all of them
+    commands = CLI_COMMANDS
+    command = cli_command_from_argv(sys.argv[1:])
+    if command in CLI_COMMANDS:
+        commands = {command: CLI_COMMANDS[command]}
+    for command, cli_command in commands.items():
+        subparser = subparsers.add_parser(command)
+        for name, kwargs in cli_command.arguments:
+            subparser.add_argument(name, **kwargs)
     args = parser.parse_args()
-    if not args.user_project_url:
-        args.user_project_url = args.url
-    api = IotApiClient(url=args.url, token=args.token)
-    paf_api = ApiClient(url=args.user_project_url, token=args.token)
+    cli_command = CLI_COMMANDS[args.command]
+    # The client only lives for this run, so reusing device lookups cannot
+    # outlast it
+    api = IotApiClient(url=args.url, token=args.token, device_cache_ttl=30)
+    paf_api = None
+    if cli_command.needs_paf:
+        args.user_project_url = args.user_project_url or args.url
+        if args.url is not None and args.user_project_url == args.url:
+            # Both APIs are served from the same place, so share the client
+            # and with it the open connections
+            paf_api = api.api
+        else:
+            from ssi.api_client import ApiClient
+            paf_api = ApiClient(url=args.user_project_url, token=args.token)
     device = None
-    if hasattr(args, "device"):
+    if cli_command.needs_device:
         device = api.get_device_fuzzy(args.device)
         if not device:
             print("No device found")
             return 1
-    if args.command == "list":
-        devices = api.list_devices()
-        if args.hostnames_only:
-            cli_print_hostnames(devices)
-        else:
-            cli_display_devices(devices)
-    elif args.command == "list-online":
-        devices = api.list_online_devices()
-        if args.hostnames_only:
-            cli_print_hostnames(devices)
-        else:
-            cli_display_devices(devices)
-    elif args.command == "list-events":
-        assert device
-        events = device.get_events(args.kind, args.limit)
-        cli_display_result_from_json_table(events)
-    elif args.command == "watch-events":
-        assert device
-        events = device.gen_events()
-        for event in events:
-            print(event)
-    elif args.command == "watch-all-events":
-        events = api.gen_device_events()
-        for event in events:
-            print(event)
-    elif args.command == "mapped-ports":
-        assert device
-        ports = device.get_mapped_ports()
-        cli_display_result(ports)
-    elif args.command == "map-port":
-        assert device
-        port = device.map_port(args.remote_port, args.remote_host)
-        print(port['local_port'])
-    elif args.command == "unmap-port":
-        assert device
-        device.unmap_port(args.local_port)
-    elif args.command == "gen-ssh-host-config":
-        assert device
-        port = device.map_port(22, 'localhost')['local_port']
-        print(f"""Host {device.hostname}
-  HostName localhost
-  Port {port}
-  User pi
-  ProxyJump things.int.subsurfaceinsights.com
-""")
-    elif args.command == "set-type":
-        assert device
-        device.set_type(args.type)
-    elif args.command == "set-hostname":
-        assert device
-        device.set_hostname(args.hostname)
-    elif args.command == "set-project":
-        assert device
-        project = paf_api("project/v2/get_project_by_subdomain", {"subdomain": args.project})
-        device.set_project(project['paf_project_id'])
-    elif args.command == "add-admin":
-        assert device
-        user_id = paf_api("user/v2/get_user_by_email",
-                          {"paf_user_email": args.email})["paf_user_id"]
-        device.add_admin(user_id)
-    elif args.command == "remove-admin":
-        assert device
-        user_id = paf_api("user/v2/get_user_by_email",
-                          {"paf_user_email": args.email})["paf_user_id"]
-        device.remove_admin(user_id)
-    elif args.command == "list-admins":
-        assert device
-        admins = device.list_admins()
-        # TODO optimize this call
-        users = [paf_api("user/v2/get_user_by_id",
-                         {"paf_user_id": user_id}) for user_id in admins]
-        cli_display_result(users)
-    elif args.command == "list-statuses":
-        assert device
-        events = device.get_status_files()
-        cli_display_result(events)
-    elif args.command == "get-status":
-        assert device
-        status = device.get_status(args.status)
-        cli_display_result(status)
-    elif args.command == "list-configs":
-        assert device
-        configs = device.get_config_files()
-        cli_display_result(configs)
-    elif args.command == "get-config":
-        assert device
-        config = device.get_config(args.config)
-        cli_display_result(config)
-    return 0
+    return cli_command.handler(args, api, paf_api, device) or 0
 
 if __name__ == "__main__":
     sys.exit(cli_tool())
@@ -1,6 +1,7 @@
 from ssi.iot_api_client import IotApiClient
 from ssi.api_client import ApiException
 import random
+import asyncio
 
 client = IotApiClient()
 client.api.trace = True
@@ -118,3 +119,36 @@ def test_events():
     assert(event['msg'] == "test")
     assert event
 
+
+def test_async_events():
+    events = client.agen_device_events([test_device])
+    test_device.set_config_key('test', 'foo', 'bar');
+    test_device.set_config_key('test', 'foo', 'baz');
+    async def first_event():
+        try:
+            return await events.__anext__()
+        finally:
+            await events.aclose()
+    event = asyncio.run(first_event())
+    assert(event['event'] == "config_changed")
+    assert(event['msg'] == "test")
+
+def test_device_lookup_cache():
+    cached_client = IotApiClient(device_cache_ttl=30)
+    device = cached_client.get_device_by_hostname('test')
+    device.const()
+    cached = cached_client.get_device_by_hostname('test')
+    assert cached is not device
+    assert cached.id == device.id
+    cached.set_type(device.type)
+    device = cached_client.get_device_fuzzy('test')
+    assert cached_client.get_device_fuzzy('test').id == device.id
+    assert client.get_device_by_hostname('test') is not \
+        client.get_device_by_hostname('test')
+
+def test_seconds_to_human():
+    assert test_device.seconds_to_human(0) == "0s"
+    assert test_device.seconds_to_human(0.4) == "0s"
+    assert test_device.seconds_to_human(-2) == "0s"
+    assert test_device.seconds_to_human(86400) == "1d"
+    assert test_device.seconds_to_human(90061) == "1d 1h 1m 1s"